@@ -1,14 +1,110 @@
 """Scene rendering for CEC1 challenge."""
+import concurrent.futures
+import functools
 import logging
 import math
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import scipy.fft
 import soundfile
-from scipy.signal import convolve
+from scipy.signal import convolve, oaconvolve
 from soundfile import SoundFile
 
-from clarity.data.utils import better_ear_speechweighted_snr, pad, sum_signals
+from clarity.data.utils import better_ear_speechweighted_snr, pad
+
+# Number of threads writing output wav files in the background
+WRITE_WORKERS = 4
+
+# Number of BRIRs kept in memory for reuse by scenes sharing a room
+BRIR_CACHE_SIZE = 64
+
+# Number of BRIR FFTs kept in memory (each is a few MB). An FFT is only reused
+# by a scene with the same room and FFT length, e.g., when re-rendering.
+BRIR_FFT_CACHE_SIZE = 8
+
+# BRIRs shorter than this are applied by direct rather than FFT convolution
+DIRECT_CONV_MAX_TAPS = 256
+
+
+@functools.lru_cache(maxsize=BRIR_CACHE_SIZE)
+def _load_brir(filename, sample_rate):
+    """Read a BRIR wavefile, caching it for reuse across scenes.
+
+    Args:
+        filename (string): Name of file to read
+        sample_rate (int): Expected sample rate
+
+    Returns:
+        np.ndarray: read-only BRIR stored as an Nx2 array of 32-bit floats
+    """
+    try:
+        brir, brir_sample_rate = soundfile.read(filename, dtype="float32")
+    except Exception as e:
+        raise Exception(f"Unable to read {filename}.") from e
+
+    if brir_sample_rate != sample_rate:
+        raise Exception(f"Sampling rate is not {sample_rate} for filename {filename}.")
+
+    # The cached array is shared by every caller
+    brir.flags.writeable = False
+    return brir
+
+
+@functools.lru_cache(maxsize=BRIR_FFT_CACHE_SIZE)
+def _brir_fft(filename, sample_rate, n_fft):
+    """Compute the real FFT of a BRIR, caching it for reuse across scenes.
+
+    Args:
+        filename (string): Name of BRIR file to read
+        sample_rate (int): Expected sample rate
+        n_fft (int): FFT length as returned by _precompute_sig_fft
+
+    Returns:
+        np.ndarray: read-only BRIR FFT with one column per ear
+    """
+    brir_fft = scipy.fft.rfft(_load_brir(filename, sample_rate), n_fft, axis=0)
+    brir_fft.flags.writeable = False
+    return brir_fft
+
+
+def _precompute_sig_fft(signal, max_h_len, n_tail):
+    """Compute the real FFT of a signal for reuse across several convolutions.
+
+    Args:
+        signal (np.ndarray): The mono or stereo signal stored as array of floats
+        max_h_len (int): Length of the longest impulse response to be applied
+        n_tail (int): Truncate output to input signal length + n_tail
+
+    Returns:
+        tuple: The signal FFT, the FFT length and the output length
+    """
+    out_len = len(signal) + n_tail
+    n_fft = scipy.fft.next_fast_len(
+        max(len(signal) + max_h_len - 1, out_len), real=True
+    )
+    # Called outside the channel thread pool so can use all cores
+    sig_fft = scipy.fft.rfft(signal, n_fft, axis=0, workers=-1)
+    if sig_fft.ndim == 1:
+        sig_fft = sig_fft[:, np.newaxis]
+    return sig_fft, n_fft, out_len
+
+
+def _conv_with_precomputed(sig_fft, n_fft, out_len, h_fft):
+    """Convolve a precomputed signal FFT with a precomputed impulse response FFT.
+
+    Args:
+        sig_fft (np.ndarray): Signal FFT as returned by _precompute_sig_fft
+        n_fft (int): FFT length as returned by _precompute_sig_fft
+        out_len (int): Output length as returned by _precompute_sig_fft
+        h_fft (np.ndarray): The impulse response FFT of length n_fft, e.g., as
+            returned by _brir_fft
+
+    Returns:
+        np.ndarray: The convolved signal truncated to out_len samples
+    """
+    return scipy.fft.irfft(sig_fft * h_fft, n_fft, axis=0)[:out_len]
 
 
 class Renderer:
@@ -16,6 +112,10 @@ class Renderer:
     SceneGenerator of CEC1 training and development sets. The render() function generates all
     simulated signals for each scene given the parameters specified in the
     metadata/scenes.train.json or metadata/scenes.dev.json file.
+
+    Output files are written by a pool of background threads owned by the
+    renderer. Call close(), or use the renderer as a context manager, to wait
+    for pending writes and release the threads.
     """
 
     def __init__(
@@ -38,6 +138,14 @@ class Renderer:
         self.pre_duration = pre_duration
         self.post_duration = post_duration
         self.test_nbits = test_nbits
+        self.num_channels = num_channels
+
+        # Half cosine ramp applied into and out of the interferer
+        ramp = np.cos(
+            np.linspace(math.pi, 2 * math.pi, int(sample_rate * ramp_duration))
+        )
+        self._ramp = ((ramp + 1) / 2).astype(np.float32)
+        self._ramp_rev = self._ramp[::-1].copy()
 
         if num_channels == 0:
             # This will only generate the initial target, masker and anechoic target signal
@@ -47,14 +155,35 @@ class Renderer:
             # e.g. num_channel = 2  => channels [1, 2, 0]
             self.channels = list(range(1, num_channels + 1)) + [0]
 
+        self._write_executor = ThreadPoolExecutor(max_workers=WRITE_WORKERS)
+        # Reusable output buffers, see _scratch_for
+        self._scratch = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Wait for pending output file writes and release the write threads.
+
+        The renderer cannot render any more scenes once closed. This also
+        clears the BRIR and BRIR FFT caches, which are shared by all renderers.
+        """
+        self._write_executor.shutdown(wait=True)
+        _brir_fft.cache_clear()
+        _load_brir.cache_clear()
+
     def read_signal(
         self, filename, offset=0, nsamples=-1, nchannels=0, offset_is_samples=False
     ):
-        """Read a wavefile and return as numpy array of floats.
+        """Read a wavefile and return as numpy array of 32-bit floats.
 
         Args:
             filename (string): Name of file to read
             offset (int, optional): Offset in samples or seconds (from start). Defaults to 0.
+            nsamples (int, optional): Number of samples to read. Defaults to -1 (all).
             nchannels: expected number of channel (default: 0 = any number OK)
             offset_is_samples (bool): measurement units for offset (default: False)
 
@@ -67,23 +196,25 @@ class Renderer:
             # Ensure incorrect error (24 bit) is not generated
             raise Exception(f"Unable to read {filename}.") from e
 
-        if nchannels not in (0, wave_file.channels):
-            raise Exception(
-                f"Wav file ({filename}) was expected to have {nchannels} channels."
-            )
+        with wave_file:
+            if nchannels not in (0, wave_file.channels):
+                raise Exception(
+                    f"Wav file ({filename}) was expected to have {nchannels} channels."
+                )
 
-        if wave_file.samplerate != self.sample_rate:
-            raise Exception(
-                f"Sampling rate is not {self.sample_rate} for filename {filename}."
-            )
+            if wave_file.samplerate != self.sample_rate:
+                raise Exception(
+                    f"Sampling rate is not {self.sample_rate} for filename {filename}."
+                )
 
-        if not offset_is_samples:  # Default behaviour
-            offset = int(offset * wave_file.samplerate)
+            if not offset_is_samples:  # Default behaviour
+                offset = int(offset * wave_file.samplerate)
 
-        if offset != 0:
-            wave_file.seek(offset)
+            if offset != 0:
+                wave_file.seek(offset)
 
-        x = wave_file.read(frames=nsamples)
+            # Only the requested frames are read and decoded from disk
+            x = wave_file.read(frames=nsamples, dtype="float32")
         return x
 
     def write_signal(
@@ -114,35 +245,88 @@ class Renderer:
         if floating_point is False:
             if self.test_nbits == 16:
                 subtype = "PCM_16"
-                # If signal is float and we want int16
-                signal *= 32768
-                signal = signal.astype(np.dtype("int16"))
-                assert np.max(signal) <= 32767 and np.min(signal) >= -32768
+                # If signal is float and we want int16 (without modifying the input)
+                signal = np.rint(np.clip(signal * 32768.0, -32768, 32767)).astype(
+                    np.int16, copy=False
+                )
             elif self.test_nbits == 24:
                 subtype = "PCM_24"
         else:
             subtype = "FLOAT"
 
-        soundfile.write(filename, signal, sample_rate, subtype=subtype)
+        with SoundFile(
+            filename,
+            mode="w",
+            samplerate=sample_rate,
+            channels=1 if signal.ndim == 1 else signal.shape[1],
+            subtype=subtype,
+            format="WAV",
+        ) as wave_file:
+            wave_file.write(signal)
+
+    def _scratch_for(self, name, shape):
+        """Return a float32 buffer reused across scenes.
+
+        The buffer only grows, so scenes of different lengths share it. If the
+        buffer was last passed to _release_scratch_after, this waits until that
+        write has finished. A failed write is not raised here as it is reported
+        by the future returned to the caller that submitted it.
+
+        Args:
+            name (str): Name identifying the buffer
+            shape (tuple): Required shape
+
+        Returns:
+            np.ndarray: Uninitialised view of the buffer with the given shape
+        """
+        buffer, write = self._scratch.get(name, (None, None))
+        if write is not None:
+            concurrent.futures.wait([write])
+        if buffer is None or buffer.shape[1:] != shape[1:] or len(buffer) < shape[0]:
+            buffer = np.empty(shape, dtype=np.float32)
+        self._scratch[name] = (buffer, None)
+        return buffer[: shape[0]]
+
+    def _release_scratch_after(self, name, write):
+        """Mark a buffer from _scratch_for as in use until a write has finished.
+
+        Args:
+            name (str): Name identifying the buffer
+            write (Future): Write of the buffer as returned by _submit_writes
+        """
+        self._scratch[name] = (self._scratch[name][0], write)
+
+    def _submit_writes(self, outputs):
+        """Write signals in the background.
 
-    def apply_ramp(self, signal, ramp_duration):
+        Args:
+            outputs (list): List of (filename, signal) pairs to write
+
+        Returns:
+            list: Futures that complete when each file has been written
+        """
+        return [
+            self._write_executor.submit(
+                self.write_signal, filename, signal, self.sample_rate
+            )
+            for filename, signal in outputs
+        ]
+
+    def apply_ramp(self, signal):
         """Apply half cosine ramp into and out of signal.
 
+        The ramp duration is set by ramp_duration in the constructor. The signal
+        is ramped in place.
+
         Args:
             signal (np.ndarray): signal to be ramped.
-            ramp_duration (int): ramp duration in seconds.
 
         Returns:
             np.ndarray: Signal ramped into and out of by cosine function.
         """
-        ramp = np.cos(
-            np.linspace(math.pi, 2 * math.pi, int(self.sample_rate * ramp_duration))
-        )
-        ramp = (ramp + 1) / 2
-        signal_ramped = np.array(signal)
-        signal_ramped[0 : len(ramp)] *= ramp
-        signal_ramped[-len(ramp) :] *= ramp[::-1]
-        return signal_ramped
+        signal[0 : len(self._ramp)] *= self._ramp
+        signal[-len(self._ramp_rev) :] *= self._ramp_rev
+        return signal
 
     def apply_brir(self, signal, brir):
         """Convolve a signal with a BRIR.
@@ -153,23 +337,64 @@ class Renderer:
             n_tail (int): Truncate output to input signal length + n_tail
 
         Returns:
-            ndarray: The convolved signals
+            ndarray: The convolved signals, zero padded to the output length if
+                the BRIR is shorter than n_tail
 
         """
         output_len = len(signal) + self.n_tail
         brir = np.squeeze(brir)
 
         if len(np.shape(signal)) == 1 and len(np.shape(brir)) == 2:
-            signal_l = convolve(signal, brir[:, 0], mode="full", method="fft")
-            signal_r = convolve(signal, brir[:, 1], mode="full", method="fft")
+            signal = signal[:, np.newaxis]
         elif len(np.shape(signal)) == 2 and len(np.shape(brir)) == 2:
-            signal_l = convolve(signal[:, 0], brir[:, 0], mode="full", method="fft")
-            signal_r = convolve(signal[:, 1], brir[:, 1], mode="full", method="fft")
+            signal = signal[:, 0:2]
         else:
             logging.error("Signal does not have the required shape.")
-        output = np.vstack([signal_l, signal_r]).T
+        brir = brir[:, 0:2]
+
+        if len(brir) < DIRECT_CONV_MAX_TAPS:
+            # Short BRIRs are cheaper to apply in the time domain
+            # (a mono signal has a single column shared by both ears)
+            output = np.column_stack(
+                [
+                    convolve(
+                        signal[:, ear % signal.shape[1]],
+                        brir[:, ear],
+                        mode="full",
+                        method="direct",
+                    )
+                    for ear in (0, 1)
+                ]
+            )
+        else:
+            # Both ears are convolved in a single call along the time axis
+            output = oaconvolve(signal, brir, mode="full", axes=0)
+        if len(output) < output_len:
+            output = pad(output, output_len)
         return output[0:output_len, :]
 
+    def apply_channel_brirs(self, brir_stem, channel, target_fft, interferer_fft):
+        """Apply a channel's target and interferer BRIRs to precomputed signal FFTs.
+
+        Args:
+            brir_stem (str): Path prefix of the scene BRIR files
+            channel (int): Channel whose BRIRs are applied
+            target_fft (tuple): Target FFT as returned by _precompute_sig_fft
+            interferer_fft (tuple): Interferer FFT as returned by _precompute_sig_fft
+
+        Returns:
+            tuple: The target and interferer signals at the ear
+        """
+        target_brir_fft = _brir_fft(
+            f"{brir_stem}_t_CH{channel}.wav", self.sample_rate, target_fft[1]
+        )
+        interferer_brir_fft = _brir_fft(
+            f"{brir_stem}_i1_CH{channel}.wav", self.sample_rate, interferer_fft[1]
+        )
+        target_at_ear = _conv_with_precomputed(*target_fft, target_brir_fft)
+        interferer_at_ear = _conv_with_precomputed(*interferer_fft, interferer_brir_fft)
+        return target_at_ear, interferer_at_ear
+
     def compute_snr(
         self, target: np.ndarray, noise: np.ndarray, pre_samples=0, post_samples=-1
     ):
@@ -213,7 +438,25 @@ class Renderer:
         dataset,
         pre_samples=88200,
         post_samples=44100,
+        wait=True,
     ):
+        """Render the signals of a scene and write them to the output path.
+
+        Scenes whose output files all exist already are skipped. There is no
+        option to force a re-render; delete the existing files to regenerate
+        a scene.
+
+        Args:
+            wait (bool): Whether to wait for the output files to be written
+                before returning (default: True)
+
+        Returns:
+            list: Futures that complete when each output file has been written
+        """
+        if check_scene_exists({"scene": scene}, self.output_path, self.num_channels):
+            logging.info("Skipping processed scene %s.", scene)
+            return []
+
         brir_stem = f"{self.input_path}/{dataset}/rooms/brir/brir_{room}"
         anechoic_brir_stem = f"{self.input_path}/{dataset}/rooms/brir/anech_brir_{room}"
         target_fn = f"{self.input_path}/{dataset}/targets/{target}.wav"
@@ -221,85 +464,166 @@ class Renderer:
             f"{self.input_path}/{dataset}/interferers/{noise_type}/{interferer}.wav"
         )
 
-        target = self.read_signal(target_fn)
-        target = np.pad(target, [(pre_samples, post_samples)])
+        raw_target = self.read_signal(target_fn)
+        target = self._scratch_for(
+            "target", (pre_samples + len(raw_target) + post_samples,)
+        )
+        target[:pre_samples] = 0
+        target[pre_samples : pre_samples + len(raw_target)] = raw_target
+        target[pre_samples + len(raw_target) :] = 0
 
         interferer_signal = self.read_signal(
             interferer_fn, offset=offset, nsamples=len(target), offset_is_samples=True
         )
 
-        if len(target) != len(interferer):
-            logging.debug("Target and interferer have different lengths")
-
         # Apply 500ms half-cosine ramp
-        interferer_signal = self.apply_ramp(
-            interferer_signal, ramp_duration=self.ramp_duration
-        )
+        interferer_signal = self.apply_ramp(interferer_signal)
 
         prefix = f"{self.output_path}/{scene}"
-        outputs = [
-            (f"{prefix}_target.wav", target),
-            (f"{prefix}_interferer.wav", interferer_signal),
-        ]
-
-        snr_ref = None
-        for channel in self.channels:
-            # Load scene BRIRs
-            target_brir_fn = f"{brir_stem}_t_CH{channel}.wav"
-            interferer_brir_fn = f"{brir_stem}_i1_CH{channel}.wav"
-            target_brir = self.read_signal(target_brir_fn)
-            interferer_brir = self.read_signal(interferer_brir_fn)
+        # Output files are written in the background as soon as they are ready
+        writes = self._submit_writes(
+            [
+                (f"{prefix}_target.wav", target),
+                (f"{prefix}_interferer.wav", interferer_signal),
+            ]
+        )
+        self._release_scratch_after("target", writes[0])
+
+        # The target and interferer FFTs are computed once and shared by all channels
+        # (sized by the longest BRIR, which also caches the BRIRs for the channels)
+        max_brir_len = max(
+            (
+                len(
+                    _load_brir(
+                        f"{brir_stem}_{source}_CH{channel}.wav", self.sample_rate
+                    )
+                )
+                for channel in self.channels
+                for source in ("t", "i1")
+            ),
+            default=0,
+        )
+        target_fft = _precompute_sig_fft(target, max_brir_len, self.n_tail)
+        interferer_fft = _precompute_sig_fft(
+            interferer_signal, max_brir_len, self.n_tail
+        )
 
-            # Apply the BRIRs
-            target_at_ear = self.apply_brir(target, target_brir)
-            interferer_at_ear = self.apply_brir(interferer_signal, interferer_brir)
+        # Each channel is convolved independently so channels are processed in
+        # parallel (FFTs release the GIL)
+        with ThreadPoolExecutor(max_workers=max(len(self.channels), 1)) as executor:
+            signals_at_ear = list(
+                executor.map(
+                    lambda channel: self.apply_channel_brirs(
+                        brir_stem, channel, target_fft, interferer_fft
+                    ),
+                    self.channels,
+                )
+            )
 
+        snr_ref = None
+        for channel, (target_at_ear, interferer_at_ear) in zip(
+            self.channels, signals_at_ear
+        ):
             # Scale interferer to obtain SNR specified in scene description
             logging.info("Scaling interferer to obtain mixture SNR = %s dB.", snr_dB)
 
             if snr_ref is None:
                 # snr_ref computed for first channel in the list and then
                 # same scaling applied to all
-                snr_ref = self.compute_snr(
-                    target_at_ear,
-                    interferer_at_ear,
-                    pre_samples=pre_samples,
-                    post_samples=post_samples,
+                # (cast to a Python float so scaling keeps signals in float32)
+                snr_ref = float(
+                    self.compute_snr(
+                        target_at_ear,
+                        interferer_at_ear,
+                        pre_samples=pre_samples,
+                        post_samples=post_samples,
+                    )
                 )
                 logging.debug("Using channel %s as reference.", channel)
+                scale = snr_ref * 10 ** ((-snr_dB) / 20)
 
             # Apply snr_ref reference scaling to get 0 dB and then scale to target snr_dB
-            interferer_at_ear = interferer_at_ear * snr_ref
-            interferer_at_ear = interferer_at_ear * 10 ** ((-snr_dB) / 20)
+            np.multiply(interferer_at_ear, scale, out=interferer_at_ear)
 
-            # Sum target and scaled and ramped interferer
-            signal_at_ear = sum_signals([target_at_ear, interferer_at_ear])
-            outputs.extend(
+            # Sum target and scaled and ramped interferer (always the same shape)
+            signal_at_ear = np.add(
+                target_at_ear,
+                interferer_at_ear,
+                out=self._scratch_for(f"mixed_CH{channel}", target_at_ear.shape),
+            )
+            channel_writes = self._submit_writes(
                 [
                     (f"{prefix}_mixed_CH{channel}.wav", signal_at_ear),
                     (f"{prefix}_target_CH{channel}.wav", target_at_ear),
                     (f"{prefix}_interferer_CH{channel}.wav", interferer_at_ear),
                 ]
             )
-
-        if self.channels == []:
-            target_brir_fn = f"{brir_stem}_t_CH0.wav"
-            target_brir = self.read_signal(target_brir_fn)
+            self._release_scratch_after(f"mixed_CH{channel}", channel_writes[0])
+            writes += channel_writes
 
         # Construct the anechoic target reference signal
         anechoic_brir_fn = (
             f"{anechoic_brir_stem}_t_CH1.wav"  # CH1 used for the anechoic signal
         )
-        anechoic_brir = self.read_signal(anechoic_brir_fn)
-        # Padding the anechoic brir very inefficient but keeps it simple
-        anechoic_brir_pad = pad(anechoic_brir, len(target_brir))
-        target_anechoic = self.apply_brir(target, anechoic_brir_pad)
+        anechoic_brir = _load_brir(anechoic_brir_fn, self.sample_rate)
+        target_anechoic = self.apply_brir(target, anechoic_brir)
+
+        writes += self._submit_writes(
+            [(f"{prefix}_target_anechoic.wav", target_anechoic)]
+        )
+
+        if wait:
+            # Wait for all output files to be written
+            for write in writes:
+                write.result()
+        return writes
 
-        outputs.append((f"{prefix}_target_anechoic.wav", target_anechoic))
+    def render_scene(self, scene, wait=True):
+        """Render a scene described in the metadata format.
+
+        Args:
+            scene (dict): Scene as stored in the metadata/scenes.train.json or
+                metadata/scenes.dev.json file
+            wait (bool): Whether to wait for the output files to be written
+                before returning (default: True)
+
+        Returns:
+            list: Futures that complete when each output file has been written
+        """
+        return self.render(
+            pre_samples=scene["pre_samples"],
+            post_samples=scene["post_samples"],
+            dataset=scene["dataset"],
+            target=scene["target"]["name"],
+            noise_type=scene["interferer"]["type"],
+            interferer=scene["interferer"]["name"],
+            room=scene["room"]["name"],
+            scene=scene["scene"],
+            offset=scene["interferer"]["offset"],
+            snr_dB=scene["SNR"],
+            wait=wait,
+        )
+
+    def render_batch(self, scenes):
+        """Render a batch of scenes, overlapping computation with file writing.
+
+        Each scene is computed while the output files of the previous scene are
+        still being written. The files of at most one previous scene are
+        pending at any time so memory use does not grow with the batch size.
+
+        Args:
+            scenes (list): List of scenes as stored in the
+                metadata/scenes.train.json or metadata/scenes.dev.json file
+        """
+        pending = []
+        for scene in scenes:
+            writes = self.render_scene(scene, wait=False)
+            for write in pending:
+                write.result()
+            pending = writes
 
-        # Write all output files
-        for filename, signal in outputs:
-            self.write_signal(filename, signal, self.sample_rate)
+        for write in pending:
+            write.result()
 
 
 def check_scene_exists(scene: dict, output_path: str, num_channels: int) -> bool:
@@ -339,7 +663,4 @@ def check_scene_exists(scene: dict, output_path: str, num_channels: int) -> bool
             ]
         )
 
-    scene_exists = True
-    for filename in files_to_check:
-        scene_exists = scene_exists and os.path.exists(filename)
-    return scene_exists
+    return all(map(os.path.exists, files_to_check))
@@ -36,10 +36,13 @@ def better_ear_speechweighted_snr(target: np.ndarray, noise: np.ndarray) -> floa
     if np.ndim(target) == 1:
         # analysis left ear and right ear for single channel target
         try:
-            left_snr = speechweighted_snr(target, noise[:, 0])
-            right_snr = speechweighted_snr(target, noise[:, 1])
+            noise_left, noise_right = noise[:, 0], noise[:, 1]
         except IndexError:
             raise
+        # the target is only filtered once and shared by both ears
+        targ_rms = speechweighted_rms(target)
+        left_snr = np.divide(targ_rms, speechweighted_rms(noise_left))
+        right_snr = np.divide(targ_rms, speechweighted_rms(noise_right))
     else:
         # analysis left ear and right ear for two channel target
         left_snr = speechweighted_snr(target[:, 0], noise[:, 0])
@@ -60,24 +63,34 @@ def speechweighted_snr(target: np.ndarray, noise: np.ndarray) -> float:
         (float):
     Signal Noise Ratio
     """
-    try:
-        target_filt = scipy.signal.convolve(
-            target, SPEECH_FILTER, mode="full", method="fft"
-        )
-        noise_filt = scipy.signal.convolve(
-            noise, SPEECH_FILTER, mode="full", method="fft"
-        )
-    except ValueError:
-        raise
     # rms of the target after speech weighted filter
-    targ_rms = np.sqrt(np.mean(target_filt**2))
+    targ_rms = speechweighted_rms(target)
 
     # rms of the noise after speech weighted filter
-    noise_rms = np.sqrt(np.mean(noise_filt**2))
+    noise_rms = speechweighted_rms(noise)
     sw_snr = np.divide(targ_rms, noise_rms)
     return sw_snr
 
 
+def speechweighted_rms(signal: np.ndarray) -> float:
+    """Apply speech weighting filter to signal and get its RMS.
+
+    Args:
+        signal (np.ndarray):
+
+    Returns:
+        (float):
+    RMS of the speech weighted signal
+    """
+    try:
+        signal_filt = scipy.signal.convolve(
+            signal, SPEECH_FILTER, mode="full", method="fft"
+        )
+    except ValueError:
+        raise
+    return np.sqrt(np.mean(signal_filt**2))
+
+
 def sum_signals(signals: list) -> Union[np.ndarray, Literal[0]]:
     """Return sum of a list of signals.
 
@@ -1,12 +1,11 @@
 import json
-import logging
 import os
 
 import hydra
 from omegaconf import DictConfig
 from tqdm import tqdm
 
-from clarity.data.scene_renderer_cec1 import Renderer, check_scene_exists
+from clarity.data.scene_renderer_cec1 import Renderer
 
 
 def prepare_data(root_path, metafile_path, scene_folder, num_channels):
@@ -23,23 +22,11 @@ def prepare_data(root_path, metafile_path, scene_folder, num_channels):
 
     os.makedirs(scene_folder, exist_ok=True)
 
-    renderer = Renderer(input_path=root_path, output_path=scene_folder, num_channels=3)
-    for scene in tqdm(scenes):
-        if check_scene_exists(scene, scene_folder, num_channels):
-            logging.info(f"Skipping processed scene {scene['scene']}.")
-        else:
-            renderer.render(
-                pre_samples=scene["pre_samples"],
-                post_samples=scene["post_samples"],
-                dataset=scene["dataset"],
-                target=scene["target"]["name"],
-                noise_type=scene["interferer"]["type"],
-                interferer=scene["interferer"]["name"],
-                room=scene["room"]["name"],
-                scene=scene["scene"],
-                offset=scene["interferer"]["offset"],
-                snr_dB=scene["SNR"],
-            )
+    with Renderer(
+        input_path=root_path, output_path=scene_folder, num_channels=num_channels
+    ) as renderer:
+        # Scenes that have already been processed are skipped by render_batch()
+        renderer.render_batch(tqdm(scenes))
 
 
 @hydra.main(config_path=".", config_name="data_config")
@@ -0,0 +1,183 @@
+"""Tests for the CEC1 scene renderer."""
+import time
+
+import numpy as np
+import pytest
+import scipy.fft
+import soundfile
+from scipy.signal import oaconvolve
+
+from clarity.data.scene_renderer_cec1 import (
+    Renderer,
+    _brir_fft,
+    _conv_with_precomputed,
+    _load_brir,
+    _precompute_sig_fft,
+    check_scene_exists,
+)
+from clarity.data.utils import pad
+
+SEED = 564231
+rng = np.random.default_rng(SEED)
+
+
+@pytest.mark.parametrize(
+    "signal, brirs, n_tail",
+    [
+        (rng.random(1000), [rng.random((100, 2)), rng.random((60, 2))], 50),
+        (rng.random((1000, 2)), [rng.random((100, 2))], 20),
+    ],
+)
+def test_conv_with_precomputed(signal, brirs, n_tail) -> None:
+    """Test that a precomputed signal FFT matches direct convolution."""
+    sig_fft = _precompute_sig_fft(signal, max(len(b) for b in brirs), n_tail)
+    for brir in brirs:
+        brir_fft = scipy.fft.rfft(brir, sig_fft[1], axis=0)
+        output = _conv_with_precomputed(*sig_fft, brir_fft)
+        for ear in (0, 1):
+            channel = signal if signal.ndim == 1 else signal[:, ear]
+            expected = oaconvolve(channel, brir[:, ear], mode="full")
+            assert output.shape == (len(signal) + n_tail, 2)
+            assert np.allclose(output[:, ear], expected[: len(signal) + n_tail])
+
+
+@pytest.mark.parametrize(
+    "signal, brir",
+    [
+        (rng.random(1000), rng.random((100, 2))),
+        (rng.random((1000, 2)), rng.random((100, 2))),
+        (rng.random(1000), rng.random((400, 2))),
+        (rng.random((1000, 2)), rng.random((400, 2))),
+    ],
+)
+def test_apply_brir(signal, brir) -> None:
+    """Test that direct and FFT convolution paths match per ear convolution."""
+    renderer = Renderer(input_path=".", output_path=".", tail_duration=0.01)
+    output = renderer.apply_brir(signal, brir)
+    assert output.shape == (len(signal) + renderer.n_tail, 2)
+    for ear in (0, 1):
+        channel = signal if signal.ndim == 1 else signal[:, ear]
+        expected = pad(oaconvolve(channel, brir[:, ear], mode="full"), len(output))
+        assert np.allclose(output[:, ear], expected[: len(output)])
+
+
+def test_write_signal_fixed_point(tmp_path) -> None:
+    """Test that 16 bit writing clips without modifying the signal."""
+    renderer = Renderer(input_path=".", output_path=tmp_path)
+    signal = np.array([[0.5, -0.5], [1.5, -1.5]], dtype=np.float32)
+    original = signal.copy()
+    filename = tmp_path / "signal.wav"
+    renderer.write_signal(filename, signal, 44100, floating_point=False)
+    written, _ = soundfile.read(filename, dtype="int16")
+    assert np.array_equal(signal, original)
+    assert np.array_equal(written, [[16384, -16384], [32767, -32768]])
+
+
+@pytest.mark.parametrize("num_channels, channels", [(0, []), (2, [1, 2, 0])])
+def test_check_scene_exists(tmp_path, num_channels, channels) -> None:
+    """Test that a scene only exists once all of its files are present."""
+    filenames = [
+        "S00001_target.wav",
+        "S00001_target_anechoic.wav",
+        "S00001_interferer.wav",
+    ]
+    for channel in channels:
+        for signal in ("mixed", "target", "interferer"):
+            filenames.append(f"S00001_{signal}_CH{channel}.wav")
+
+    for filename in filenames:
+        assert not check_scene_exists({"scene": "S00001"}, tmp_path, num_channels)
+        (tmp_path / filename).touch()
+    assert check_scene_exists({"scene": "S00001"}, tmp_path, num_channels)
+
+
+def make_scene(name, pre_samples=88200, post_samples=44100, offset=5376) -> dict:
+    """Make a scene using the test data in the metadata format."""
+    return {
+        "room": {"name": "R00001"},
+        "target": {"name": "T010_G0N_02468"},
+        "interferer": {"name": "CIN_fan_014", "type": "noise", "offset": offset},
+        "scene": name,
+        "dataset": ".",
+        "pre_samples": pre_samples,
+        "post_samples": post_samples,
+        "SNR": 0.586,
+    }
+
+
+@pytest.mark.parametrize(
+    "scenes",
+    [
+        [make_scene("S00001"), make_scene("S00002"), make_scene("S00003")],
+        [
+            make_scene("S00001"),
+            make_scene("S00002", pre_samples=44100, post_samples=22050, offset=100),
+            make_scene("S00003", pre_samples=99225, post_samples=40000, offset=9000),
+            make_scene("S00004", pre_samples=22050, post_samples=44100),
+        ],
+    ],
+)
+def test_render_batch(tmp_path, scenes) -> None:
+    """Test that a batch of scenes matches rendering each scene on its own."""
+    (tmp_path / "batch").mkdir()
+    with Renderer(
+        input_path="tests/test_data", output_path=tmp_path / "batch", num_channels=1
+    ) as renderer:
+        renderer.render_batch(scenes)
+
+    for scene in scenes:
+        scene_path = tmp_path / scene["scene"]
+        scene_path.mkdir()
+        with Renderer(
+            input_path="tests/test_data", output_path=scene_path, num_channels=1
+        ) as renderer:
+            renderer.render_scene(scene)
+
+        # target, interferer, anechoic target plus 3 files for each of 2 channels
+        assert len(list(scene_path.iterdir())) == 9
+        for filename in scene_path.iterdir():
+            expected, _ = soundfile.read(filename)
+            output, _ = soundfile.read(tmp_path / "batch" / filename.name)
+            assert np.array_equal(output, expected)
+
+
+def test_close(tmp_path) -> None:
+    """Test that leaving the context manager waits for writes and shuts down."""
+    with Renderer(
+        input_path="tests/test_data", output_path=tmp_path, num_channels=1
+    ) as renderer:
+        # Slow writes down so they are still pending when the renderer is closed
+        write_signal = renderer.write_signal
+
+        def slow_write_signal(*args):
+            time.sleep(0.1)
+            write_signal(*args)
+
+        renderer.write_signal = slow_write_signal
+        writes = renderer.render_scene(make_scene("S00001"), wait=False)
+        assert not all(write.done() for write in writes)
+    assert all(write.done() for write in writes)
+    assert check_scene_exists(make_scene("S00001"), tmp_path, num_channels=1)
+
+    assert _load_brir.cache_info().currsize == 0
+    assert _brir_fft.cache_info().currsize == 0
+
+    with pytest.raises(RuntimeError):
+        renderer.render_scene(make_scene("S00002"))
+
+
+def test_render_after_failed_write(tmp_path) -> None:
+    """Test that a failed write does not prevent later scenes from rendering."""
+    # A directory in place of an output file makes its write fail
+    (tmp_path / "S00001_target.wav").mkdir()
+    with Renderer(
+        input_path="tests/test_data", output_path=tmp_path, num_channels=1
+    ) as renderer:
+        for name in ("S00001", "S00002", "S00003"):
+            scene = make_scene(name)
+            if name == "S00001":
+                with pytest.raises(RuntimeError):
+                    renderer.render_scene(scene)
+            else:
+                renderer.render_scene(scene)
+                assert check_scene_exists(scene, tmp_path, num_channels=1)
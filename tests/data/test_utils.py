@@ -5,8 +5,10 @@ import numpy as np
 import pytest
 
 from clarity.data.utils import (
+    SPEECH_FILTER,
     better_ear_speechweighted_snr,
     pad,
+    speechweighted_rms,
     speechweighted_snr,
     sum_signals,
 )
@@ -90,6 +92,12 @@ def test_speechweighted_snr_unequal_arrays_value_error() -> None:
         )
 
 
+def test_speechweighted_rms() -> None:
+    """Test of speechweighted_rms()."""
+    rms = speechweighted_rms(np.asarray([1.0]))
+    assert rms == np.sqrt(np.mean(SPEECH_FILTER**2))
+
+
 @pytest.mark.parametrize(
     "signals, expected",
     [
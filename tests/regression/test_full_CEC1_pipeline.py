@@ -70,24 +70,23 @@ def test_full_CEC1_pipeline(regtest):
     }
 
     with tempfile.TemporaryDirectory() as output_path:
-        renderer = Renderer(
+        with Renderer(
             input_path="tests/test_data",
             output_path=output_path,
             num_channels=3,
-        )
-
-        renderer.render(
-            pre_samples=scene["pre_samples"],
-            post_samples=scene["post_samples"],
-            dataset=scene["dataset"],
-            target=scene["target"]["name"],
-            noise_type=scene["interferer"]["type"],
-            interferer=scene["interferer"]["name"],
-            room=scene["room"]["name"],
-            scene=scene["scene"],
-            offset=scene["interferer"]["offset"],
-            snr_dB=scene["SNR"],
-        )
+        ) as renderer:
+            renderer.render(
+                pre_samples=scene["pre_samples"],
+                post_samples=scene["post_samples"],
+                dataset=scene["dataset"],
+                target=scene["target"]["name"],
+                noise_type=scene["interferer"]["type"],
+                interferer=scene["interferer"]["name"],
+                room=scene["room"]["name"],
+                scene=scene["scene"],
+                offset=scene["interferer"]["offset"],
+                snr_dB=scene["SNR"],
+            )
 
         _, reference = wavfile.read(f"{output_path}/S06001_target_anechoic.wav")
         _, signal = wavfile.read(f"{output_path}/S06001_mixed_CH1.wav")